@@ -6,9 +6,9 @@ from utils.logger import logger
 from utils.routes import routes
 from utils.config import get_config, load_config
 from services.database import init_db
-from services.stats import load_stats_from_db, save_stats_to_db, update_file_stats, add_log
+from services.stats import load_stats_from_db, save_stats_to_db, add_log
 from services.mirrors import load_mirrors_from_db, save_mirror_to_db, get_all_mirrors, get_upstream_key
-from services.cache_manager import clean_old_cache, load_blacklist_from_db
+from services.cache_manager import maintain_cache, load_blacklist_from_db
 from services.proxy import handle_connect, proxy_package_logic, direct_proxy
 
 
@@ -19,19 +19,11 @@ def background_tasks():
     """Background thread to clean cache and save stats periodically"""
     last_cleanup = 0
     last_save = 0
-    last_file_scan = 0
     
     # Wait for config to be loaded
     while not get_config('storage_path_resolved'):
         time.sleep(1)
 
-    # Initial scan
-    try:
-        update_file_stats()
-    except Exception as e:
-        logger.error(f"Initial file stats update failed: {e}")
-    last_file_scan = time.time()
-
     while True:
         try:
             current_time = time.time()
@@ -40,15 +32,11 @@ def background_tasks():
             if current_time - last_save > 60:
                 save_stats_to_db()
                 last_save = current_time
-                
-            # Update file stats every 5 minutes (expensive operation)
-            if current_time - last_file_scan > 300:
-                update_file_stats()
-                last_file_scan = current_time
 
-            # Clean cache every hour
+            # Clean cache and recount file stats in one pass every hour (first run at startup);
+            # in between FILE_STATS is kept current incrementally
             if current_time - last_cleanup > 3600:
-                clean_old_cache()
+                maintain_cache()
                 last_cleanup = current_time
         except Exception as e:
             logger.error(f"Error in background tasks: {e}")
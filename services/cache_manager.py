@@ -1,23 +1,88 @@
 import os
 import hashlib
+import functools
 import time
 import threading
 import requests
 import re
 import gzip
+import mmap
+import fnmatch
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from pathlib import Path
-from datetime import datetime, timedelta
-from flask import Response
+from flask import Response, send_file
 from utils.logger import logger
-from utils.config import get_config
-from services.stats import STATS, stats_lock, add_log, save_stats_to_db
+from utils.config import get_config, get_storage_path
+from services.stats import STATS_FLUSH_BYTES, add_bytes_served, add_log, adjust_file_stats, set_file_stats, save_stats_to_db
 from services.database import db_lock, get_db_connection
 from services.mirrors import get_all_mirrors, get_upstream_key
+from services.upstream import SESSION
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # In-memory blacklist cache
 BLACKLIST_PATTERNS = []
+# Precompiled matchers rebuilt whenever BLACKLIST_PATTERNS changes
+BLACKLIST_REGEX = None
+BLACKLIST_SUBSTRINGS = ()
 blacklist_lock = threading.Lock()
 
+# Streaming buffer size
+CHUNK_SIZE = 1024 * 1024
+# Save stats to DB after every SAVE_STATS_EVERY cache fills (process-wide;
+# next() on itertools.count is atomic under the GIL)
+SAVE_STATS_EVERY = 10
+_fill_counter = itertools.count(1)
+
+# Short-lived memo of cache paths known to be valid: path -> expiry timestamp
+VALIDITY_CACHE = {}
+VALIDITY_CACHE_SIZE = 4096
+VALIDITY_TTL = 5
+validity_lock = threading.Lock()
+
+# Extended attributes holding upstream validators for conditional revalidation
+ETAG_XATTR = 'user.aptproxy.etag'
+LAST_MODIFIED_XATTR = 'user.aptproxy.last_modified'
+
+# Whether O_TMPFILE + link works on the storage filesystem (probed on first cache fill)
+TMPFILE_SUPPORTED = None
+
+# In-flight cache fills: key -> InflightFill, sharded to avoid a single hot lock
+INFLIGHT_BUCKETS = 64
+# Longest a waiter goes without new bytes from the fill it is following
+INFLIGHT_WAIT_TIMEOUT = 120
+# How often a waiter at the end of the growing file checks for more data
+INFLIGHT_POLL_INTERVAL = 0.2
+INFLIGHT = [(threading.Lock(), {}) for _ in range(INFLIGHT_BUCKETS)]
+
+# Fields looked up within a matching Packages stanza
+PACKAGES_FILENAME_RE = re.compile(rb'(?m)^Filename:[ \t]*([^\n]+)')
+PACKAGES_VERSION_RE = re.compile(rb'(?m)^Version:[ \t]*([^\n]+)')
+
+def _rebuild_blacklist_matchers():
+    """Rebuild the combined wildcard regex and substring tuple (caller holds blacklist_lock)"""
+    global BLACKLIST_REGEX, BLACKLIST_SUBSTRINGS
+    wildcard_patterns = [p for p in BLACKLIST_PATTERNS if '*' in p]
+    plain_patterns = [p for p in BLACKLIST_PATTERNS if '*' not in p]
+
+    regex = None
+    if wildcard_patterns:
+        # fnmatch.translate anchors with \Z, strip it so patterns match anywhere like before
+        parts = [fnmatch.translate(p).removesuffix(r'\Z') for p in wildcard_patterns]
+        try:
+            regex = re.compile('|'.join(parts), re.IGNORECASE)
+        except re.error as e:
+            logger.error(f"Error compiling blacklist patterns: {e}")
+
+    BLACKLIST_REGEX = regex
+    BLACKLIST_SUBSTRINGS = tuple(p.lower() for p in plain_patterns)
+
 def load_blacklist_from_db():
     """Load package blacklist patterns from database"""
     global BLACKLIST_PATTERNS
@@ -30,6 +95,7 @@ def load_blacklist_from_db():
             
             with blacklist_lock:
                 BLACKLIST_PATTERNS = [row['pattern'] for row in rows]
+                _rebuild_blacklist_matchers()
                 
             logger.info(f"Loaded {len(BLACKLIST_PATTERNS)} blacklist patterns")
     except Exception as e:
@@ -48,6 +114,7 @@ def add_blacklist_pattern(pattern):
         with blacklist_lock:
             if pattern not in BLACKLIST_PATTERNS:
                 BLACKLIST_PATTERNS.append(pattern)
+                _rebuild_blacklist_matchers()
                 
         logger.info(f"Added blacklist pattern: {pattern}")
         return True
@@ -68,6 +135,7 @@ def remove_blacklist_pattern(pattern):
         with blacklist_lock:
             if pattern in BLACKLIST_PATTERNS:
                 BLACKLIST_PATTERNS.remove(pattern)
+                _rebuild_blacklist_matchers()
                 
         logger.info(f"Removed blacklist pattern: {pattern}")
         return True
@@ -82,124 +150,246 @@ def get_blacklist_patterns():
 def is_blacklisted(filename):
     """Check if a filename matches any blacklist pattern"""
     with blacklist_lock:
-        for pattern in BLACKLIST_PATTERNS:
-            try:
-                # Simple wildcard matching or regex? Let's assume simple substring or regex
-                # If pattern contains *, treat as simple glob-like regex
-                if '*' in pattern:
-                    regex = pattern.replace('.', '\.').replace('*', '.*')
-                    if re.search(regex, filename, re.IGNORECASE):
-                        return True
-                elif pattern.lower() in filename.lower():
-                    return True
-            except:
-                pass
+        regex = BLACKLIST_REGEX
+        substrings = BLACKLIST_SUBSTRINGS
+
+    if regex is not None and regex.search(filename) is not None:
+        return True
+    if substrings:
+        lowered = filename.lower()
+        return any(s in lowered for s in substrings)
     return False
 
+@functools.lru_cache(maxsize=4096)
+def _hash_path(path):
+    """Non-cryptographic hash of an upstream path, used to name cache files"""
+    data = path.encode()
+    if xxhash is not None:
+        return xxhash.xxh3_64_hexdigest(data)
+    # Same 64-bit digest length as xxh3 so cache names keep one shape either way
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+@dataclass(slots=True)
+class CacheEntry:
+    """Location of a cached upstream file"""
+    path: Path
+    real_name: str
+    path_hash: str
+
 def get_cache_path(distro, path):
     """Generate a safe cache file path"""
-    storage_path = Path(get_config('storage_path_resolved'))
-    path_hash = hashlib.md5(path.encode()).hexdigest()
-    filename = os.path.basename(path) if os.path.basename(path) else 'index'
+    storage_path = get_storage_path()
+    path_hash = _hash_path(path)
+    filename = path.rsplit('/', 1)[-1] or 'index'
     cache_dir = storage_path / distro / path_hash[:2]
-    cache_dir.mkdir(parents=True, exist_ok=True)
-    return cache_dir / f"{path_hash}_{filename}"
+    # The shard directory is only created when a file is actually written to it
+    return CacheEntry(cache_dir / f"{path_hash}_{filename}", filename, path_hash)
+
+def invalidate_cache_validity(cache_path):
+    """Drop a memoized is_cache_valid result for cache_path"""
+    with validity_lock:
+        VALIDITY_CACHE.pop(str(cache_path), None)
 
 def is_cache_valid(cache_path):
     """Check if cached file is still valid"""
-    if not cache_path.exists():
+    key = str(cache_path)
+    now = time.time()
+    
+    # Recently validated hot files skip the stat syscall entirely
+    with validity_lock:
+        expires_at = VALIDITY_CACHE.get(key)
+    if expires_at is not None and expires_at > now:
+        return True
+    
+    # A single stat doubles as the existence check
+    try:
+        stat = os.stat(key)
+    except OSError:
         return False
     
     # Check if retention is enabled
     if not get_config('cache_retention_enabled', True):
-        return True
+        valid = True
+        ttl = VALIDITY_TTL
+    else:
+        cache_days = get_config('cache_days', 7)
+        max_age = cache_days * 24 * 60 * 60
+        # Same last-access rule as clean_cache_tree, so validity and cleanup agree
+        valid = now - max(stat.st_atime, stat.st_mtime) < max_age
+        ttl = min(max_age, VALIDITY_TTL)
+    
+    if valid:
+        with validity_lock:
+            if len(VALIDITY_CACHE) >= VALIDITY_CACHE_SIZE:
+                VALIDITY_CACHE.clear()
+            VALIDITY_CACHE[key] = now + ttl
+    return valid
+
+def scan_cache_tree(root_dir, cutoff_time=None):
+    """Walk a distro tree once, removing files last accessed before cutoff_time (if set)
 
-    cache_days = get_config('cache_days', 7)
+    Returns (files, size, removed, removed_size) where files/size cover the
+    files left in place.
+    """
+    d_files = 0
+    d_size = 0
+    removed = 0
+    removed_size = 0
     
-    # Check last access time (atime) if available, otherwise mtime
-    try:
-        last_access = cache_path.stat().st_atime
-    except:
-        last_access = cache_path.stat().st_mtime
-        
-    file_age = datetime.now() - datetime.fromtimestamp(last_access)
-    return file_age < timedelta(days=cache_days)
+    # Use stack-based scandir for better performance
+    stack = [root_dir]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as scanner:
+                for entry in scanner:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        try:
+                            # entry.stat() is cached; mtime covers filesystems that don't track atime
+                            stat = entry.stat(follow_symlinks=False)
+                            
+                            if cutoff_time is not None and max(stat.st_atime, stat.st_mtime) < cutoff_time:
+                                os.unlink(entry.path)
+                                invalidate_cache_validity(entry.path)
+                                removed += 1
+                                removed_size += stat.st_size
+                                continue
+                            
+                            d_files += 1
+                            d_size += stat.st_size
+                        except Exception:
+                            pass
+        except Exception as e:
+            logger.error(f"Error scanning {current_dir}: {e}")
+    
+    return d_files, d_size, removed, removed_size
 
-def clean_old_cache():
-    """Remove cache files older than CACHE_DAYS based on last access"""
+def maintain_cache(clean=True, recount=True):
+    """Single pass over the cache: remove stale files (clean) and/or recompute FILE_STATS (recount)"""
     try:
-        if not get_config('cache_retention_enabled', True):
-            logger.info("Cache retention disabled, skipping cleanup")
+        storage_path = get_storage_path()
+        if storage_path is None or not storage_path.exists():
             return
 
-        storage_path_str = get_config('storage_path_resolved')
-        if not storage_path_str:
-            return
-
-        storage_path = Path(storage_path_str)
-        cache_days = get_config('cache_days', 7)
-        cutoff_time = time.time() - (cache_days * 24 * 60 * 60)
+        cutoff_time = None
+        if clean:
+            if get_config('cache_retention_enabled', True):
+                cache_days = get_config('cache_days', 7)
+                cutoff_time = time.time() - (cache_days * 24 * 60 * 60)
+            else:
+                logger.info("Cache retention disabled, skipping cleanup")
+                if not recount:
+                    return
+        
+        # Cached files always live under a per-distro directory
+        with os.scandir(storage_path) as it:
+            distro_dirs = {
+                entry.name: entry.path for entry in it
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')
+            }
         
         cleaned_count = 0
+        distro_stats = {}
         
-        # Use stack-based scandir for better performance
-        stack = [str(storage_path)]
-        while stack:
-            current_dir = stack.pop()
-            try:
-                with os.scandir(current_dir) as scanner:
-                    for entry in scanner:
-                        if entry.is_dir():
-                            stack.append(entry.path)
-                        elif entry.is_file():
-                            try:
-                                # entry.stat() is cached
-                                stat = entry.stat()
-                                last_access = stat.st_atime
-                                
-                                # Fallback to mtime if atime is not updated/reliable or older than mtime
-                                if stat.st_mtime > last_access:
-                                    last_access = stat.st_mtime
-
-                                if last_access < cutoff_time:
-                                    os.remove(entry.path)
-                                    cleaned_count += 1
-                            except Exception:
-                                pass
-            except Exception as e:
-                logger.error(f"Error scanning {current_dir}: {e}")
+        # Walk each distro tree in parallel; workers return their own totals
+        max_workers = min(8, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(scan_cache_tree, path, cutoff_time): distro for distro, path in distro_dirs.items()}
+            for future in as_completed(futures):
+                distro = futures[future]
+                d_files, d_size, removed, removed_size = future.result()
+                distro_stats[distro] = {'files': d_files, 'size': d_size}
+                if removed and not recount:
+                    adjust_file_stats(distro, -removed, -removed_size)
+                cleaned_count += removed
+        
+        if recount:
+            set_file_stats(distro_stats)
+            logger.info("File stats updated")
         
         if cleaned_count > 0:
             logger.info(f"Cleanup: Removed {cleaned_count} old files (accessed > {cache_days} days ago)")
             add_log(f"Cleanup: Removed {cleaned_count} old files", "INFO")
             
     except Exception as e:
-        logger.error(f"Error during cache cleanup: {e}")
-        add_log(f"Error during cache cleanup: {e}", "ERROR")
+        logger.error(f"Error during cache maintenance: {e}")
+        add_log(f"Error during cache maintenance: {e}", "ERROR")
+
+def clean_old_cache():
+    """Remove cache files older than CACHE_DAYS based on last access"""
+    maintain_cache(clean=True, recount=False)
+
+def update_file_stats():
+    """Recalculate file statistics from disk (expensive, run on startup or on demand)"""
+    maintain_cache(clean=False, recount=True)
 
 def delete_cached_file(rel_path):
     """Delete a specific file from cache"""
     try:
-        storage_path_str = get_config('storage_path_resolved')
-        if not storage_path_str:
+        storage_path = get_storage_path()
+        if storage_path is None:
             return False
             
-        full_path = Path(storage_path_str) / rel_path
+        full_path = storage_path / rel_path
         
         # Security check
-        if not str(full_path).startswith(str(Path(storage_path_str).resolve())):
+        if not str(full_path).startswith(str(storage_path.resolve())):
             return False
             
-        if full_path.exists():
-            full_path.unlink()
-            logger.info(f"Deleted cached file: {rel_path}")
-            add_log(f"Deleted file: {rel_path}", "INFO")
-            return True
-        return False
+        try:
+            size = full_path.stat().st_size
+        except FileNotFoundError:
+            return False
+            
+        full_path.unlink()
+        invalidate_cache_validity(full_path)
+        adjust_file_stats(full_path.relative_to(storage_path).parts[0], -1, -size)
+        logger.info(f"Deleted cached file: {rel_path}")
+        add_log(f"Deleted file: {rel_path}", "INFO")
+        return True
     except Exception as e:
         logger.error(f"Error deleting file {rel_path}: {e}")
         return False
 
+def scan_packages_buffer(buf, query_bytes, distro, matches):
+    """Append packages from a Packages file buffer whose name contains query_bytes"""
+    # Jump between Package: lines with find (memchr/two-way search in C) and
+    # only look at the rest of a stanza when its name matches
+    if buf[:8] == b'Package:':
+        start = 0
+    else:
+        start = buf.find(b'\nPackage:')
+        if start != -1:
+            start += 1
+    
+    while start != -1:
+        name_end = buf.find(b'\n', start)
+        if name_end == -1:
+            name_end = len(buf)
+        next_start = buf.find(b'\nPackage:', name_end)
+        
+        name = buf[start + 8:name_end].strip()
+        if query_bytes in name.lower():
+            stanza = buf[name_end:next_start if next_start != -1 else len(buf)]
+            filename = PACKAGES_FILENAME_RE.search(stanza)
+            if filename:
+                # Check if cached
+                pkg_path = filename[1].decode('utf-8', errors='ignore').strip()
+                is_cached = is_cache_valid(get_cache_path(distro, pkg_path).path)
+
+                version = PACKAGES_VERSION_RE.search(stanza)
+                matches.append({
+                    'name': name.decode('utf-8', errors='ignore'),
+                    'path': pkg_path,
+                    'distro': distro,
+                    'version': version[1].decode('utf-8', errors='ignore').strip() if version else 'unknown',
+                    'cached': is_cached
+                })
+        
+        start = next_start + 1 if next_start != -1 else -1
+
 def search_upstream_packages(distro, query):
     """Search for packages in upstream mirror by checking Packages.gz if available or simple path check"""
     results = []
@@ -214,14 +404,25 @@ def search_upstream_packages(distro, query):
             if isinstance(mirrors, str):
                 mirrors = [mirrors]
             
-            for mirror in mirrors:
+            def probe(mirror):
                 url = f"{mirror}/{query}"
                 try:
-                    resp = requests.head(url, timeout=2)
+                    resp = SESSION.head(url, timeout=2)
                     if resp.status_code == 200:
+                        return url
+                except:
+                    pass
+                return None
+
+            # Probe all mirrors at once and take the first that has the file
+            executor = ThreadPoolExecutor(max_workers=min(8, len(mirrors)) or 1)
+            try:
+                futures = [executor.submit(probe, mirror) for mirror in mirrors]
+                for future in as_completed(futures):
+                    url = future.result()
+                    if url:
                         # Check if already cached
-                        cache_path = get_cache_path(distro, query)
-                        is_cached = is_cache_valid(cache_path)
+                        is_cached = is_cache_valid(get_cache_path(distro, query).path)
                         
                         results.append({
                             'name': os.path.basename(query), 
@@ -232,16 +433,16 @@ def search_upstream_packages(distro, query):
                         })
                         # Return immediately if found direct match
                         return results
-                except:
-                    pass
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
 
     # 2. If not a path, or path not found, try to search in cached Packages files
     # We look for *Packages.gz* or *Packages* files in our cache for this distro
-    storage_path_str = get_config('storage_path_resolved')
-    if not storage_path_str:
+    storage_path = get_storage_path()
+    if storage_path is None:
         return results
         
-    storage_path = Path(storage_path_str) / distro
+    storage_path = storage_path / distro
     if not storage_path.exists():
         return results
 
@@ -249,72 +450,58 @@ def search_upstream_packages(distro, query):
     limit = 20
     count = 0
     
+    query_bytes = query.lower().encode('utf-8', errors='ignore')
+
     # Helper to parse Packages file content
-    def parse_packages_file(filepath):
+    def parse_packages_file(filepath, is_gzip):
         matches = []
         try:
-            if str(filepath).endswith('.gz'):
-                f = gzip.open(filepath, 'rt', encoding='utf-8', errors='ignore')
+            if is_gzip:
+                with gzip.open(filepath, 'rb') as f:
+                    scan_packages_buffer(f.read(), query_bytes, distro, matches)
             else:
-                f = open(filepath, 'r', encoding='utf-8', errors='ignore')
-            
-            with f:
-                current_pkg = {}
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        if current_pkg and 'Package' in current_pkg and 'Filename' in current_pkg:
-                            if query.lower() in current_pkg['Package'].lower():
-                                # Check if cached
-                                pkg_path = current_pkg['Filename']
-                                cache_path = get_cache_path(distro, pkg_path)
-                                is_cached = is_cache_valid(cache_path)
-                                
-                                matches.append({
-                                    'name': current_pkg['Package'],
-                                    'path': pkg_path,
-                                    'distro': distro,
-                                    'version': current_pkg.get('Version', 'unknown'),
-                                    'cached': is_cached
-                                })
-                        current_pkg = {}
-                        continue
-                    
-                    if ':' in line:
-                        key, val = line.split(':', 1)
-                        current_pkg[key.strip()] = val.strip()
+                with open(filepath, 'rb') as f:
+                    # mmap plain files to avoid copying them into memory
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        scan_packages_buffer(buf, query_bytes, distro, matches)
         except Exception:
             pass
         return matches
 
     # Find Packages files in cache
     # They are usually stored as hash_Packages or hash_Packages.gz
-    for root, dirs, files in os.walk(storage_path):
-        for filename in files:
-            if 'Packages' in filename:
-                # Check if it's a real Packages file (by name part)
-                parts = filename.split('_', 1)
-                real_name = parts[1] if len(parts) > 1 else filename
-                
-                if 'Packages' in real_name:
-                    file_matches = parse_packages_file(os.path.join(root, filename))
-                    for m in file_matches:
-                        results.append(m)
-                        count += 1
-                        if count >= limit:
-                            return results
-        if count >= limit:
-            break
-            
+    # Use stack-based scandir and stop as soon as the limit is reached
+    stack = [str(storage_path)]
+    while stack and count < limit:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as scanner:
+                for entry in scanner:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif 'Packages' in entry.name:
+                        # Check if it's a real Packages file (by name part)
+                        parts = entry.name.split('_', 1)
+                        real_name = parts[1] if len(parts) > 1 else entry.name
+
+                        if 'Packages' in real_name:
+                            for m in parse_packages_file(entry.path, entry.name.endswith('.gz')):
+                                results.append(m)
+                                count += 1
+                                if count >= limit:
+                                    return results
+        except Exception:
+            pass
+
     return results
 
 def manual_cache_package(distro, package_path):
     """Manually download and cache a package"""
     try:
-        cache_path = get_cache_path(distro, package_path)
+        entry = get_cache_path(distro, package_path)
         
         # Check if already cached
-        if is_cache_valid(cache_path):
+        if is_cache_valid(entry.path):
             return True, "File already cached"
 
         upstream_key = get_upstream_key(distro, package_path)
@@ -334,7 +521,7 @@ def manual_cache_package(distro, package_path):
         
         # Use stream_and_cache but consume the response to force download
         headers = {'User-Agent': 'apt-cache-proxy-manual'}
-        response = stream_and_cache(upstream_urls, cache_path, headers)
+        response = stream_and_cache(upstream_urls, entry, headers)
         
         if response.status_code == 200:
             # Consume the generator to ensure file is written
@@ -348,124 +535,457 @@ def manual_cache_package(distro, package_path):
         logger.error(f"Error manual caching {distro}/{package_path}: {e}")
         return False, str(e)
 
-def stream_and_cache(urls, cache_path, headers):
+@dataclass(slots=True)
+class InflightFill:
+    """A cache fill in progress, shared between its owner and waiting requests"""
+    started_at: float
+    # Set once the fill has finished, successfully or not
+    done: threading.Event = field(default_factory=threading.Event)
+    # Set once source is published or the fill is done
+    ready: threading.Event = field(default_factory=threading.Event)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Path waiters can open to read the partially written file
+    source: str = None
+    headers: dict = None
+    committed: bool = False
+    # Requests that joined to follow source; the owner keeps filling while any have
+    followers: int = 0
+
+def claim_inflight(key):
+    """Register a cache fill for key, returning (fill, is_owner)"""
+    lock, pending = INFLIGHT[hash(key) & (INFLIGHT_BUCKETS - 1)]
+    now = time.time()
+    with lock:
+        current = pending.get(key)
+        # A fill that never started streaming within the timeout is treated as abandoned
+        if current is not None and (current.source is not None or now - current.started_at < INFLIGHT_WAIT_TIMEOUT):
+            return current, False
+        fill = InflightFill(now)
+        pending[key] = fill
+        return fill, True
+
+def release_inflight(key, fill):
+    """Finish a cache fill started with claim_inflight and wake any waiters"""
+    lock, pending = INFLIGHT[hash(key) & (INFLIGHT_BUCKETS - 1)]
+    with lock:
+        if pending.get(key) is fill:
+            del pending[key]
+    fill.done.set()
+    fill.ready.set()
+
+def publish_inflight_source(fill, source, headers):
+    """Let waiters follow the owner's temp file while it is being written"""
+    with fill.lock:
+        fill.source = source
+        fill.headers = headers
+    fill.ready.set()
+
+def withdraw_inflight_source(fill):
+    """Stop new waiters opening the temp file (must happen before its fd is closed)"""
+    with fill.lock:
+        fill.source = None
+
+def withdraw_unfollowed_source(fill):
+    """Withdraw the temp file if nobody has joined to follow it, returning whether it was"""
+    with fill.lock:
+        if fill.followers:
+            return False
+        fill.source = None
+        return True
+
+def join_inflight_source(fill):
+    """Register as a follower of the owner's temp file, or False if it is no longer available"""
+    with fill.lock:
+        if fill.source is None:
+            return False
+        fill.followers += 1
+        return True
+
+def open_inflight_source(fill):
+    """Open the owner's temp file for reading, or None if it is no longer available"""
+    with fill.lock:
+        if fill.source is None:
+            return None
+        try:
+            return os.open(fill.source, os.O_RDONLY)
+        except OSError:
+            return None
+
+def follow_inflight_fill(fill, cache_path):
+    """Stream a file that another request is still downloading, ending when its fill does"""
+    # Opened on first read rather than by the caller, so a body that is never
+    # iterated (HEAD, client gone before the first chunk) never holds an fd
+    fd = open_inflight_source(fill)
+    if fd is None:
+        # The temp file was withdrawn before we got to it, so the fill is finishing
+        fill.done.wait(INFLIGHT_WAIT_TIMEOUT)
+        if not fill.committed:
+            raise IOError("upstream download being followed failed")
+        fd = os.open(cache_path, os.O_RDONLY)
+    local_bytes = 0
+    last_progress = time.time()
+    try:
+        while True:
+            # Sample done before reading: everything is written by the time it is set,
+            # so an empty read taken after seeing it really is the end of the file
+            finished = fill.done.is_set()
+            chunk = os.read(fd, CHUNK_SIZE)
+            if chunk:
+                last_progress = time.time()
+                local_bytes += len(chunk)
+                if local_bytes >= STATS_FLUSH_BYTES:
+                    add_bytes_served(local_bytes)
+                    local_bytes = 0
+                yield chunk
+                continue
+            
+            if finished:
+                if not fill.committed:
+                    # Abort the response rather than hand the client a truncated file
+                    raise IOError("upstream download being followed failed")
+                return
+            
+            if time.time() - last_progress > INFLIGHT_WAIT_TIMEOUT:
+                raise IOError("upstream download being followed stalled")
+            fill.done.wait(INFLIGHT_POLL_INTERVAL)
+    finally:
+        os.close(fd)
+        add_bytes_served(local_bytes)
+
+def read_validators(cache_path):
+    """Return the (ETag, Last-Modified) upstream sent for a cached file, if recorded"""
+    values = []
+    for name in (ETAG_XATTR, LAST_MODIFIED_XATTR):
+        try:
+            values.append(os.getxattr(cache_path, name).decode('latin-1'))
+        except (AttributeError, OSError):
+            values.append(None)
+    return tuple(values)
+
+def store_validators(fd, upstream_headers):
+    """Record upstream ETag/Last-Modified as xattrs on an open cache file"""
+    for name, header in ((ETAG_XATTR, 'ETag'), (LAST_MODIFIED_XATTR, 'Last-Modified')):
+        value = upstream_headers.get(header)
+        if not value:
+            continue
+        try:
+            os.setxattr(fd, name, value.encode('latin-1'))
+        except (AttributeError, OSError, UnicodeEncodeError):
+            # No xattr support (platform or filesystem): the file just won't be revalidated
+            return
+
+def link_tmpfile(fd, dst):
+    """Give the anonymous O_TMPFILE file open on fd the name dst"""
+    # Plain os.link(f'/proc/self/fd/{fd}', ...) is link(2), which won't follow the
+    # magic symlink and fails with EXDEV; linkat with AT_SYMLINK_FOLLOW does
+    proc_fd = os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.link(str(fd), dst, src_dir_fd=proc_fd, follow_symlinks=True)
+    finally:
+        os.close(proc_fd)
+
+def probe_tmpfile_support(cache_dir):
+    """Check once whether anonymous O_TMPFILE files can be linked into cache_dir"""
+    if not hasattr(os, 'O_TMPFILE'):
+        return False
+    probe_path = os.path.join(cache_dir, f".tmpfile-probe-{os.getpid()}-{threading.get_ident()}")
+    try:
+        fd = os.open(cache_dir, os.O_TMPFILE | os.O_WRONLY, 0o644)
+    except OSError:
+        return False
+    try:
+        link_tmpfile(fd, probe_path)
+        os.unlink(probe_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+def open_cache_temp(cache_dir):
+    """Open a temp file for a cache fill in cache_dir, returning (fd, temp_path)
+
+    Uses an anonymous O_TMPFILE where supported (temp_path is None), so
+    nothing appears in the cache until commit_cache_temp links it in.
+    """
+    global TMPFILE_SUPPORTED
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    if TMPFILE_SUPPORTED is None:
+        TMPFILE_SUPPORTED = probe_tmpfile_support(cache_dir)
+    if TMPFILE_SUPPORTED:
+        try:
+            return os.open(cache_dir, os.O_TMPFILE | os.O_WRONLY, 0o644), None
+        except OSError:
+            pass
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.fchmod(fd, 0o644)
+    return fd, temp_path
+
+def commit_cache_temp(fd, temp_path, cache_path):
+    """Atomically publish a finished temp file from open_cache_temp at cache_path"""
+    if temp_path is None:
+        try:
+            link_tmpfile(fd, cache_path)
+            return
+        except FileExistsError:
+            # Refreshing an expired entry: link under a unique name, then swap it in
+            link_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            link_tmpfile(fd, link_path)
+            try:
+                os.replace(link_path, cache_path)
+            except OSError:
+                os.unlink(link_path)
+                raise
+            return
+    os.replace(temp_path, cache_path)
+
+def write_all(fd, data):
+    """Write a buffer to a raw file descriptor, retrying on short writes"""
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+def generate_passthrough(raw):
+    """Stream an upstream response body without caching it"""
+    local_bytes = 0
+    try:
+        while True:
+            chunk = raw.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            local_bytes += len(chunk)
+            if local_bytes >= STATS_FLUSH_BYTES:
+                add_bytes_served(local_bytes)
+                local_bytes = 0
+            yield chunk
+    finally:
+        add_bytes_served(local_bytes)
+
+def stream_and_cache(urls, entry, headers):
     """Stream content from upstream and cache it locally"""
     if isinstance(urls, str):
         urls = [urls]
     
-    # Check blacklist
-    filename = cache_path.name
-    # The cache path name is hash_filename, we want the real filename
-    parts = filename.split('_', 1)
-    real_filename = parts[1] if len(parts) > 1 else filename
+    cache_path = entry.path
+    # Check blacklist against the real filename, not the hash-prefixed cache name
+    real_filename = entry.real_name
     
     should_cache = not is_blacklisted(real_filename)
     if not should_cache:
         logger.info(f"File blacklisted, will not cache: {real_filename}")
         add_log(f"BLACKLISTED: {real_filename}", "WARNING")
 
-    last_error = None
+    inflight_key = str(cache_path)
+    inflight = None
+    if should_cache:
+        # Single-flight: only one request fills a given cache file at a time
+        fill, is_owner = claim_inflight(inflight_key)
+        if is_owner:
+            inflight = fill
+        else:
+            logger.info(f"Following in-flight download: {cache_path.name}")
+            # Stream the owner's temp file as it grows instead of waiting for it to finish
+            if fill.ready.wait(INFLIGHT_WAIT_TIMEOUT):
+                if join_inflight_source(fill):
+                    add_log(f"HIT (shared): {cache_path.name}", "SUCCESS")
+                    return Response(follow_inflight_fill(fill, cache_path), status=200, headers=fill.headers)
+                # The temp file was just withdrawn, so the fill is finishing
+                fill.done.wait(INFLIGHT_WAIT_TIMEOUT)
+            if is_cache_valid(cache_path):
+                add_log(f"HIT (shared): {cache_path.name}", "SUCCESS")
+                add_bytes_served(cache_path.stat().st_size)
+                return send_file(cache_path)
+            # The other download failed or never started, fetch it ourselves
+
+    # Revalidate an expired copy with the validators saved when it was fetched
+    revalidating = False
+    upstream_headers = headers
+    if inflight is not None:
+        etag, last_modified = read_validators(cache_path)
+        if etag or last_modified:
+            revalidating = True
+            upstream_headers = {k: v for k, v in headers.items() if k.lower() not in ('if-none-match', 'if-modified-since')}
+            if etag:
+                upstream_headers['If-None-Match'] = etag
+            if last_modified:
+                upstream_headers['If-Modified-Since'] = last_modified
+
+    # Ownership passes to generate_cached once it is returned to the client
+    handed_off = False
+    try:
+        last_error = None
     
-    for url in urls:
-        try:
-            logger.info(f"Fetching from upstream: {url}")
-            # allow_redirects=True is default, but explicit is good
-            # Increase chunk size for better throughput
-            response = requests.get(url, stream=True, headers=headers, timeout=20, allow_redirects=True)
+        pending_urls = list(urls)
+        while pending_urls:
+            url = pending_urls.pop(0)
+            try:
+                logger.info(f"Fetching from upstream: {url}")
+                # allow_redirects=True is default, but explicit is good
+                # Increase chunk size for better throughput
+                response = SESSION.get(url, stream=True, headers=upstream_headers, timeout=20, allow_redirects=True)
             
-            if response.status_code == 404:
-                logger.warning(f"File not found (404): {url}")
-                # Don't return immediately, try other mirrors? 
-                # Usually 404 means it's not there, but maybe mirror sync issue.
-                last_error = "404 Not Found"
-                continue
+                if response.status_code == 404:
+                    logger.warning(f"File not found (404): {url}")
+                    # Don't return immediately, try other mirrors? 
+                    # Usually 404 means it's not there, but maybe mirror sync issue.
+                    last_error = "404 Not Found"
+                    continue
             
-            # Handle success or partial/not-modified
-            if response.status_code in [200, 206, 304]:
+                # Handle success or partial/not-modified
+                if response.status_code in [200, 206, 304]:
                 
-                resp_headers = {}
-                excluded_headers = ['transfer-encoding', 'connection', 'content-encoding', 'content-length']
-                for key, value in response.headers.items():
-                    if key.lower() not in excluded_headers:
-                        resp_headers[key] = value
-
-                # If 304 Not Modified, just return it
-                if response.status_code == 304:
-                    add_log(f"HIT (304): {cache_path.name}", "SUCCESS")
-                    return Response(status=304, headers=resp_headers)
-
-                # If 206 Partial Content, stream but don't cache (too complex to merge)
-                if response.status_code == 206:
-                    add_log(f"PARTIAL: {cache_path.name}", "WARNING")
-                    def generate_partial():
-                        # Increased chunk size to 1MB
-                        for chunk in response.iter_content(chunk_size=1024 * 1024):
-                            if chunk:
-                                with stats_lock:
-                                    STATS['bytes_served'] += len(chunk)
-                                yield chunk
-                    return Response(generate_partial(), status=206, headers=resp_headers)
-
-                # If 200 OK
-                if should_cache:
-                    # Cache it
-                    temp_path = cache_path.with_suffix('.tmp')
-                    
-                    def generate_cached():
+                    resp_headers = {}
+                    excluded_headers = ['transfer-encoding', 'connection', 'content-encoding', 'content-length']
+                    for key, value in response.headers.items():
+                        if key.lower() not in excluded_headers:
+                            resp_headers[key] = value
+
+                    # Our expired copy is still current: refresh its age and serve it
+                    if response.status_code == 304 and revalidating:
+                        response.close()
                         try:
-                            with open(temp_path, 'wb') as f:
-                                # Increased chunk size to 1MB
-                                for chunk in response.iter_content(chunk_size=1024 * 1024):
-                                    if chunk:
-                                        f.write(chunk)
-                                        chunk_len = len(chunk)
-                                        with stats_lock:
-                                            STATS['bytes_served'] += chunk_len
-                                        yield chunk
+                            os.utime(cache_path, None)
+                            file_size = cache_path.stat().st_size
+                            revalidated_response = send_file(cache_path)
+                        except OSError:
+                            # Removed (cleanup, admin delete) since its validators were read:
+                            # fetch it from this mirror again, unconditionally
+                            logger.info(f"Revalidated copy is gone, refetching: {cache_path.name}")
+                            revalidating = False
+                            upstream_headers = headers
+                            pending_urls.insert(0, url)
+                            continue
+                        invalidate_cache_validity(cache_path)
+                        add_log(f"REVALIDATED: {cache_path.name}", "SUCCESS")
+                        add_bytes_served(file_size)
+                        return revalidated_response
+
+                    # If 304 Not Modified, just return it
+                    if response.status_code == 304:
+                        add_log(f"HIT (304): {cache_path.name}", "SUCCESS")
+                        return Response(status=304, headers=resp_headers)
+
+                    # Read straight from the urllib3 stream, decoding any Content-Encoding
+                    raw = response.raw
+                    raw.decode_content = True
+
+                    # If 206 Partial Content, stream but don't cache (too complex to merge)
+                    if response.status_code == 206:
+                        add_log(f"PARTIAL: {cache_path.name}", "WARNING")
+                        return Response(generate_passthrough(raw), status=206, headers=resp_headers)
+
+                    # If 200 OK
+                    if should_cache:
+                        # Cache it
+                        def generate_cached():
+                            fd = None
+                            temp_path = None
+                            committed = False
+                            local_bytes = 0
+                            try:
+                                fd, temp_path = open_cache_temp(cache_path.parent)
+                                if inflight is not None:
+                                    publish_inflight_source(inflight, temp_path or f'/proc/self/fd/{fd}', resp_headers)
+                                buf = bytearray(CHUNK_SIZE)
+                                view = memoryview(buf)
+                                detached = False
+                                while True:
+                                    n = raw.readinto(buf)
+                                    if not n:
+                                        break
+                                    write_all(fd, view[:n])
+                                    if detached:
+                                        continue
+                                    local_bytes += n
+                                    if local_bytes >= STATS_FLUSH_BYTES:
+                                        add_bytes_served(local_bytes)
+                                        local_bytes = 0
+                                    try:
+                                        yield bytes(view[:n])
+                                    except GeneratorExit:
+                                        # Our client went away. Other requests are streaming this
+                                        # temp file, so finish the download for them (inside close())
+                                        if inflight is None or withdraw_unfollowed_source(inflight):
+                                            raise
+                                        logger.info(f"Client left, finishing download for followers: {cache_path.name}")
+                                        detached = True
                             
-                            temp_path.rename(cache_path)
-                            logger.info(f"Cached to: {cache_path}")
-                            add_log(f"CACHED: {cache_path.name}", "SUCCESS")
-                            # Trigger save occasionally on write
-                            if STATS['bytes_served'] % (10 * 1024 * 1024) == 0:
-                                # Use a separate thread but don't hold onto request context
-                                threading.Thread(target=save_stats_to_db).start()
-                        except Exception as e:
-                            logger.error(f"Error during caching: {e}")
-                            add_log(f"Error caching {cache_path.name}: {e}", "ERROR")
-                            if temp_path.exists():
-                                temp_path.unlink()
+                                file_size = os.fstat(fd).st_size
+                                store_validators(fd, response.headers)
+                                
+                                # A refresh replaces an existing file, only count the size difference
+                                try:
+                                    old_size = os.stat(cache_path).st_size
+                                    files_delta = 0
+                                except FileNotFoundError:
+                                    old_size = 0
+                                    files_delta = 1
+                                
+                                commit_cache_temp(fd, temp_path, cache_path)
+                                committed = True
+                                invalidate_cache_validity(cache_path)
+                                # Cache layout is <storage>/<distro>/<shard>/<file>
+                                adjust_file_stats(cache_path.parent.parent.name, files_delta, file_size - old_size)
+                                logger.info(f"Cached to: {cache_path}")
+                                add_log(f"CACHED: {cache_path.name}", "SUCCESS")
+                                # Trigger save occasionally on write
+                                if next(_fill_counter) % SAVE_STATS_EVERY == 0:
+                                    # Use a separate thread but don't hold onto request context
+                                    threading.Thread(target=save_stats_to_db).start()
+                            except Exception as e:
+                                logger.error(f"Error during caching: {e}")
+                                add_log(f"Error caching {cache_path.name}: {e}", "ERROR")
+                            finally:
+                                if inflight is not None:
+                                    inflight.committed = committed
+                                    withdraw_inflight_source(inflight)
+                                # Anonymous temp files vanish on close; named fallbacks need removing
+                                if fd is not None:
+                                    os.close(fd)
+                                if not committed and temp_path is not None:
+                                    try:
+                                        os.unlink(temp_path)
+                                    except OSError:
+                                        pass
+                                add_bytes_served(local_bytes)
+                                if inflight is not None:
+                                    release_inflight(inflight_key, inflight)
                     
-                    return Response(
-                        generate_cached(),
-                        status=200,
-                        headers=resp_headers,
-                        direct_passthrough=True
-                    )
-                else:
-                    # Don't cache, just stream
-                    def generate_stream():
-                        # Increased chunk size to 1MB
-                        for chunk in response.iter_content(chunk_size=1024 * 1024):
-                            if chunk:
-                                with stats_lock:
-                                    STATS['bytes_served'] += len(chunk)
-                                yield chunk
-                    return Response(generate_stream(), status=200, headers=resp_headers)
+                        handed_off = True
+                        cached_response = Response(
+                            generate_cached(),
+                            status=200,
+                            headers=resp_headers,
+                            direct_passthrough=True
+                        )
+                        if inflight is not None:
+                            # The body is never iterated for HEAD, so generate_cached's finally
+                            # may not run; release the claim and upstream connection on close
+                            def release_on_close():
+                                response.close()
+                                release_inflight(inflight_key, inflight)
+                            cached_response.call_on_close(release_on_close)
+                        return cached_response
+                    else:
+                        # Don't cache, just stream
+                        return Response(generate_passthrough(raw), status=200, headers=resp_headers)
             
-            # If we got here, it's an error code (500, 502, 403, etc)
-            logger.warning(f"Upstream returned status {response.status_code} for {url}")
-            last_error = f"HTTP {response.status_code}"
-            continue 
+                # If we got here, it's an error code (500, 502, 403, etc)
+                logger.warning(f"Upstream returned status {response.status_code} for {url}")
+                last_error = f"HTTP {response.status_code}"
+                continue 
         
-        except requests.Timeout:
-            logger.error(f"Timeout fetching {url}")
-            last_error = "Timeout"
-            continue
-        except requests.RequestException as e:
-            logger.error(f"Error fetching {url}: {e}")
-            last_error = str(e)
-            continue
+            except requests.Timeout:
+                logger.error(f"Timeout fetching {url}")
+                last_error = "Timeout"
+                continue
+            except requests.RequestException as e:
+                logger.error(f"Error fetching {url}: {e}")
+                last_error = str(e)
+                continue
 
-    add_log(f"FAILED: {cache_path.name} ({last_error})", "ERROR")
-    return Response(f"All upstream mirrors failed. Last error: {last_error}", status=502)
+        add_log(f"FAILED: {cache_path.name} ({last_error})", "ERROR")
+        return Response(f"All upstream mirrors failed. Last error: {last_error}", status=502)
+    finally:
+        if inflight is not None and not handed_off:
+            release_inflight(inflight_key, inflight)
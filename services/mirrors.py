@@ -1,10 +1,10 @@
 import json
 import socket
-import requests
 from threading import Lock
 from utils.logger import logger
 from services.database import db_lock, get_db_connection
 from utils.config import get_config
+from services.upstream import SESSION
 
 # In-memory cache of DB mirrors
 # Structure: {'name': {'urls': [...], 'status': 'approved'}}
@@ -74,7 +74,7 @@ def validate_mirror(url):
     """Check if the mirror URL is reachable"""
     try:
         # Use HEAD request to check if it exists
-        resp = requests.head(url, timeout=5, allow_redirects=True)
+        resp = SESSION.head(url, timeout=5, allow_redirects=True)
         return resp.status_code < 400
     except:
         return False
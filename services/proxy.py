@@ -1,13 +1,13 @@
 import socket
 import select
-import requests
 import os
 import time
 from flask import Response, request, send_file
 from utils.logger import logger
 from utils.config import get_config
-from services.stats import STATS, stats_lock, add_log
+from services.stats import STATS, STATS_FLUSH_BYTES, stats_lock, add_bytes_served, add_log
 from services.mirrors import get_all_mirrors, get_upstream_key
+from services.upstream import SESSION
 from services.cache_manager import get_cache_path, is_cache_valid, stream_and_cache
 
 def serve_from_cache(cache_path):
@@ -15,16 +15,17 @@ def serve_from_cache(cache_path):
     logger.info(f"Serving from cache: {cache_path}")
     add_log(f"HIT: {cache_path.name}", "SUCCESS")
     try:
+        # One stat provides both the mtime to preserve and the size served
+        stat = os.stat(cache_path)
+
         # Update access time (atime) to track last hit
         try:
-            os.utime(cache_path, (time.time(), os.path.getmtime(cache_path)))
+            os.utime(cache_path, (time.time(), stat.st_mtime))
         except Exception as e:
             logger.warning(f"Failed to update atime for {cache_path}: {e}")
 
         # Use send_file to handle conditional GETs (If-Modified-Since) automatically
-        file_size = cache_path.stat().st_size
-        with stats_lock:
-            STATS['bytes_served'] += file_size
+        add_bytes_served(stat.st_size)
             
         return send_file(cache_path)
     except Exception as e:
@@ -38,15 +39,21 @@ def direct_proxy(url, headers):
         logger.info(f"Direct proxying: {url}")
         add_log(f"PROXY: {url}", "INFO")
         # Increased chunk size for better throughput
-        resp = requests.get(url, headers=headers, stream=True, timeout=20, allow_redirects=True)
+        resp = SESSION.get(url, headers=headers, stream=True, timeout=20, allow_redirects=True)
         
         def generate():
-            # Increased chunk size to 1MB
-            for chunk in resp.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    with stats_lock:
-                        STATS['bytes_served'] += len(chunk)
-                    yield chunk
+            local_bytes = 0
+            try:
+                # Increased chunk size to 1MB
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        local_bytes += len(chunk)
+                        if local_bytes >= STATS_FLUSH_BYTES:
+                            add_bytes_served(local_bytes)
+                            local_bytes = 0
+                        yield chunk
+            finally:
+                add_bytes_served(local_bytes)
         
         excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
         headers = [(name, value) for (name, value) in resp.raw.headers.items()
@@ -63,11 +70,11 @@ def proxy_package_logic(distro, package_path):
     with stats_lock:
         STATS['requests_total'] += 1
 
-    cache_path = get_cache_path(distro, package_path)
-    if is_cache_valid(cache_path):
+    entry = get_cache_path(distro, package_path)
+    if is_cache_valid(entry.path):
         with stats_lock:
             STATS['cache_hits'] += 1
-        return serve_from_cache(cache_path)
+        return serve_from_cache(entry.path)
 
     upstream_key = get_upstream_key(distro, package_path)
     mirrors_config = get_all_mirrors()
@@ -92,7 +99,7 @@ def proxy_package_logic(distro, package_path):
     
     headers = {key: value for key, value in request.headers if key.lower() != 'host'}
     
-    response = stream_and_cache(upstream_urls, cache_path, headers)
+    response = stream_and_cache(upstream_urls, entry, headers)
 
     if response.status_code == 304:
         with stats_lock:
@@ -1,12 +1,10 @@
 import json
-import os
 import time
+from collections import deque
 from datetime import datetime
 from threading import Lock
 from utils.logger import logger
 from services.database import db_lock, get_db_connection
-from utils.config import get_config
-from pathlib import Path
 
 STATS = {
     'requests_total': 0,
@@ -20,8 +18,10 @@ FILE_STATS = {
     'total_size': 0,
     'distro_stats': {}
 }
-LOG_BUFFER = []
 MAX_LOG_BUFFER = 100
+LOG_BUFFER = deque(maxlen=MAX_LOG_BUFFER)
+# Streams accumulate bytes_served locally and only publish once this many bytes are pending
+STATS_FLUSH_BYTES = 16 * 1024 * 1024
 
 stats_lock = Lock()
 file_stats_lock = Lock()
@@ -33,9 +33,14 @@ def add_log(message, level='INFO'):
     entry = {'time': timestamp, 'level': level, 'message': message}
     
     with log_lock:
+        # deque evicts the oldest entry once MAX_LOG_BUFFER is reached
         LOG_BUFFER.append(entry)
-        if len(LOG_BUFFER) > MAX_LOG_BUFFER:
-            LOG_BUFFER.pop(0)
+
+def add_bytes_served(count):
+    """Publish a locally accumulated bytes_served delta to STATS"""
+    if count:
+        with stats_lock:
+            STATS['bytes_served'] += count
 
 def load_stats_from_db():
     """Load statistics from database into memory"""
@@ -72,53 +77,24 @@ def save_stats_to_db():
     except Exception as e:
         logger.error(f"Error saving stats to DB: {e}")
 
-def update_file_stats():
-    """Calculate file statistics (expensive operation)"""
-    try:
-        total_files = 0
-        total_size = 0
-        distro_stats = {}
-        storage_path_str = get_config('storage_path_resolved')
-        
-        if storage_path_str:
-            storage_path = Path(storage_path_str)
-            if storage_path.exists():
-                # Use os.scandir for better performance
-                with os.scandir(storage_path) as it:
-                    for entry in it:
-                        if entry.is_dir() and not entry.name.startswith('.'):
-                            distro = entry.name
-                            d_files = 0
-                            d_size = 0
-                            
-                            # Recursive scan for this distro using stack
-                            stack = [entry.path]
-                            while stack:
-                                current_dir = stack.pop()
-                                try:
-                                    with os.scandir(current_dir) as scanner:
-                                        for item in scanner:
-                                            if item.is_file():
-                                                d_files += 1
-                                                try:
-                                                    # item.stat() is cached
-                                                    d_size += item.stat().st_size
-                                                except:
-                                                    pass
-                                            elif item.is_dir():
-                                                stack.append(item.path)
-                                except Exception:
-                                    pass
-                            
-                            distro_stats[distro] = {'files': d_files, 'size': d_size}
-                            total_files += d_files
-                            total_size += d_size
+def adjust_file_stats(distro, files_delta, size_delta):
+    """Apply an incremental change to FILE_STATS when cache files are added or removed"""
+    with file_stats_lock:
+        FILE_STATS['total_files'] += files_delta
+        FILE_STATS['total_size'] += size_delta
         
-        with file_stats_lock:
-            FILE_STATS['total_files'] = total_files
-            FILE_STATS['total_size'] = total_size
-            FILE_STATS['distro_stats'] = distro_stats
-        
-        logger.info("File stats updated")
-    except Exception as e:
-        logger.error(f"Error updating file stats: {e}")
+        # Copy on write so readers holding the previous dict never see it change
+        distro_stats = dict(FILE_STATS['distro_stats'])
+        current = distro_stats.get(distro, {'files': 0, 'size': 0})
+        distro_stats[distro] = {
+            'files': current['files'] + files_delta,
+            'size': current['size'] + size_delta
+        }
+        FILE_STATS['distro_stats'] = distro_stats
+
+def set_file_stats(distro_stats):
+    """Replace FILE_STATS with totals from a full scan ({distro: {'files', 'size'}})"""
+    with file_stats_lock:
+        FILE_STATS['total_files'] = sum(d['files'] for d in distro_stats.values())
+        FILE_STATS['total_size'] = sum(d['size'] for d in distro_stats.values())
+        FILE_STATS['distro_stats'] = distro_stats
@@ -0,0 +1,15 @@
+import http.cookiejar
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP session so upstream requests reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+# The session serves every client, so never store or replay upstream cookies
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+# No retries, and read=False so read timeouts still surface as requests.Timeout
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=Retry(total=0, read=False))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
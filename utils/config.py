@@ -1,14 +1,22 @@
 import os
 import json
 import logging
+import tempfile
 from pathlib import Path
 from threading import Lock
+from types import MappingProxyType
 from utils.logger import logger
 
 # Global configuration
 BASE_DIR = Path(__file__).resolve().parent.parent
-CONFIG = {}
+# Read-only snapshot; writers build a new dict and rebind CONFIG under config_lock
+CONFIG = MappingProxyType({})
 config_lock = Lock()
+# Resolved storage Path, published on config load for lock-free reads
+STORAGE_PATH_RESOLVED = None
+# Contents of config.json as last read/written, and the file mtime at that point
+DISK_CONFIG = {}
+DISK_CONFIG_MTIME = None
 
 def is_docker():
     """Check if running inside a Docker container"""
@@ -37,34 +45,74 @@ def get_config_path():
     return data_dir / 'config.json'
 
 def get_config(key, default=None):
-    with config_lock:
-        return CONFIG.get(key, default)
+    # Readers never lock: CONFIG is immutable and only ever replaced wholesale
+    return CONFIG.get(key, default)
+
+def get_storage_path():
+    """Return the resolved storage Path without taking config_lock"""
+    return STORAGE_PATH_RESOLVED
+
+def resolve_storage_path(storage_path_str):
+    """Resolve a configured storage path against BASE_DIR and ensure it exists"""
+    if os.path.isabs(storage_path_str):
+        storage_path = Path(storage_path_str)
+    else:
+        storage_path = BASE_DIR / storage_path_str
+    storage_path.mkdir(parents=True, exist_ok=True)
+    return storage_path
+
+def write_config_file(config_path, data):
+    """Atomically write config data as JSON, returning the new file mtime"""
+    fd, tmp_path = tempfile.mkstemp(dir=config_path.parent, prefix='.config.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ': '), indent=2, sort_keys=False)
+        # mkstemp creates 0600 files, keep the mode the config file already had
+        try:
+            os.chmod(tmp_path, os.stat(config_path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, config_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return os.stat(config_path).st_mtime
 
 def save_config_value(key, value):
     """Update a single config value and save to disk"""
-    global CONFIG
+    global CONFIG, STORAGE_PATH_RESOLVED, DISK_CONFIG, DISK_CONFIG_MTIME
     try:
         config_path = get_config_path()
         
-        # Read current file first to preserve comments/structure if possible (though json lib won't)
-        # or just use current memory state? Better to read fresh to avoid overwriting external changes
-        if config_path.exists():
-            with open(config_path, 'r') as f:
-                current_disk_config = json.load(f)
-        else:
-            current_disk_config = CONFIG.copy()
-            
-        current_disk_config[key] = value
-        
-        with open(config_path, 'w') as f:
-            json.dump(current_disk_config, f, indent=2)
-            
-        # Update memory
         with config_lock:
-            CONFIG[key] = value
+            # Only re-read the file if something else modified it since we last touched it
+            try:
+                mtime = os.stat(config_path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None and mtime != DISK_CONFIG_MTIME:
+                with open(config_path, 'r') as f:
+                    DISK_CONFIG = json.load(f)
+                
+            new_disk_config = dict(DISK_CONFIG)
+            new_disk_config[key] = value
+            DISK_CONFIG_MTIME = write_config_file(config_path, new_disk_config)
+            DISK_CONFIG = new_disk_config
+            
+            # Update memory
+            new_config = dict(CONFIG)
+            new_config[key] = value
             # Special handling for side effects
             if key == 'log_level':
                 logger.setLevel(getattr(logging, value))
+            elif key == 'storage_path':
+                storage_path = resolve_storage_path(value)
+                new_config['storage_path_resolved'] = str(storage_path)
+                STORAGE_PATH_RESOLVED = storage_path
+            CONFIG = MappingProxyType(new_config)
                 
         logger.info(f"Config updated: {key} = {value}")
         return True
@@ -74,37 +122,39 @@ def save_config_value(key, value):
 
 def load_config():
     """Load configuration from JSON file"""
-    global CONFIG
+    global CONFIG, STORAGE_PATH_RESOLVED, DISK_CONFIG, DISK_CONFIG_MTIME
     try:
         config_path = get_config_path()
         
         if not config_path.exists():
             logger.info(f"Config file not found at {config_path}, creating default.")
-            with open(config_path, 'w') as f:
-                json.dump(DEFAULT_CONFIG, f, indent=2)
-            new_config = DEFAULT_CONFIG
+            disk_config = dict(DEFAULT_CONFIG)
+            disk_mtime = write_config_file(config_path, disk_config)
         else:
             with open(config_path, 'r') as f:
-                new_config = json.load(f)
+                disk_config = json.load(f)
+            disk_mtime = os.stat(config_path).st_mtime
             
-        with config_lock:
-            CONFIG.clear()
-            CONFIG.update(new_config)
-            
-            if is_docker():
-                CONFIG['storage_path'] = 'storage'
-                CONFIG['database_path'] = 'data/stats.db'
+        new_config = dict(disk_config)
+        
+        if is_docker():
+            new_config['storage_path'] = 'storage'
+            new_config['database_path'] = 'data/stats.db'
 
-            # Ensure storage path exists
-            storage_path_str = CONFIG.get('storage_path', 'storage')
-            if os.path.isabs(storage_path_str):
-                storage_path = Path(storage_path_str)
-            else:
-                storage_path = BASE_DIR / storage_path_str
-            
-            storage_path.mkdir(parents=True, exist_ok=True)
-            # Store resolved path back to config for easier access
-            CONFIG['storage_path_resolved'] = str(storage_path)
+        # Ensure storage path exists; a reload with an unchanged path reuses the resolved one
+        storage_path_str = new_config.get('storage_path', 'storage')
+        if STORAGE_PATH_RESOLVED is not None and CONFIG.get('storage_path', 'storage') == storage_path_str:
+            storage_path = STORAGE_PATH_RESOLVED
+        else:
+            storage_path = resolve_storage_path(storage_path_str)
+        # Store resolved path back to config for easier access
+        new_config['storage_path_resolved'] = str(storage_path)
+        
+        with config_lock:
+            CONFIG = MappingProxyType(new_config)
+            STORAGE_PATH_RESOLVED = storage_path
+            DISK_CONFIG = disk_config
+            DISK_CONFIG_MTIME = disk_mtime
             
             # Update log level if changed
             logger.setLevel(getattr(logging, CONFIG.get('log_level', 'INFO')))
@@ -5,7 +5,7 @@ from flask import Blueprint, Response, request, render_template, jsonify, send_f
 from utils.config import get_config, load_config, save_config_value
 from services.stats import STATS, FILE_STATS, LOG_BUFFER, stats_lock, file_stats_lock, log_lock
 from services.mirrors import get_all_mirrors, get_mirrors_management, update_mirror, delete_mirror, save_mirror_to_db
-from services.cache_manager import clean_old_cache, delete_cached_file, get_blacklist_patterns, add_blacklist_pattern, remove_blacklist_pattern, manual_cache_package, search_upstream_packages
+from services.cache_manager import clean_old_cache, update_file_stats, delete_cached_file, get_blacklist_patterns, add_blacklist_pattern, remove_blacklist_pattern, manual_cache_package, search_upstream_packages
 
 routes = Blueprint('routes', __name__)
 
@@ -334,6 +334,14 @@ def manual_cleanup():
     clean_old_cache()
     return {'status': 'cleanup completed'}
 
+@routes.route('/rescan')
+def manual_rescan():
+    """Recalculate cache file statistics from disk"""
+    if not check_auth():
+        return Response("Unauthorized", status=401)
+    update_file_stats()
+    return {'status': 'file stats recalculated'}
+
 @routes.route('/reload')
 def reload_configuration():
     """Reload configuration from disk"""